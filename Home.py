@@ -1,37 +1,160 @@
 import streamlit as st
 from pathlib import Path
 import duckdb
+import numpy as np
+from numba import njit
 import chromadb
-from chromadb.utils import embedding_functions
-import os
+import json
+import hashlib
+import openai
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import xml.etree.ElementTree as ET
 import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+# Number of documents sent to ChromaDB per add() call
+CHROMA_BATCH_SIZE = 500
+
+# OpenAI embedding model; text-embedding-3 embeddings can be shortened to fewer
+# dimensions, which makes them cheaper to store and compare
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIMENSIONS = 256
+
+# OpenAI embedding request limits (inputs per request, estimated tokens per request)
+EMBEDDING_MAX_INPUTS = 2048
+EMBEDDING_MAX_TOKENS = 8000
+
+# Number of titles downloaded and parsed concurrently
+MAX_FETCH_WORKERS = 8
+
+# Cumulative versions over time for each title, materialized as the
+# versions_cum table after each load for the Edits Over Time page. Only days with changes are
+# returned; the page draws step lines, which carry each count forward.
+VERSIONS_CUM_QUERY = """
+    WITH daily_versions AS (
+        -- Count all and substantive versions per title and day
+        SELECT 
+            title,
+            date,
+            COUNT(*) as daily_total,
+            COUNT(*) FILTER (WHERE substantive) as daily_substantive
+        FROM content_versions
+        GROUP BY title, date
+    )
+    SELECT 
+        dv.title,
+        t.name as title_name,
+        dv.date,
+        SUM(dv.daily_total) OVER (
+            PARTITION BY dv.title
+            ORDER BY dv.date
+            ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW
+        ) as total_versions,
+        SUM(dv.daily_substantive) OVER (
+            PARTITION BY dv.title
+            ORDER BY dv.date
+            ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW
+        ) as substantive_versions
+    FROM daily_versions dv
+    JOIN titles t ON t.number = dv.title
+    ORDER BY dv.title, dv.date
+    """
+
+# Word counts summed by agency, materialized as the agency_word_totals
+# table after each load for the Word Counts page
+AGENCY_WORD_TOTALS_QUERY = """
+    WITH agency_chapters AS (
+        -- Get all chapters associated with each agency
+        SELECT DISTINCT
+            a.name as agency_name,
+            a.display_name,
+            acr.title,
+            acr.chapter
+        FROM agencies a
+        JOIN agency_cfr_references acr ON a.name = acr.agency_name
+    ),
+    agency_word_counts AS (
+        -- Sum word counts for each agency's chapters
+        SELECT 
+            ac.agency_name,
+            ac.display_name,
+            SUM(wc.word_count) as total_words
+        FROM agency_chapters ac
+        JOIN word_counts wc ON 
+            ac.title = wc.title AND
+            ac.chapter = wc.chapter
+        WHERE wc.chapter IS NOT NULL
+        GROUP BY ac.agency_name, ac.display_name
+    )
+    SELECT 
+        COALESCE(display_name, agency_name) as agency,
+        total_words
+    FROM agency_word_counts
+    """
+
+# HNSW index and embedding settings for the ChromaDB collection; these only
+# take effect when the collection is created
+COLLECTION_METADATA = {
+    "hnsw:space": "cosine",
+    "hnsw:construction_ef": 200,
+    "hnsw:search_ef": 100,
+    "hnsw:M": 16,
+    "embedding_model": EMBEDDING_MODEL,
+    "embedding_dimensions": EMBEDDING_DIMENSIONS,
+}
 
 # API endpoints
 VERSIONER_API = "https://www.ecfr.gov/api/versioner/v1"
 ADMIN_API = "https://www.ecfr.gov/api/admin/v1"
 
+# Shared HTTP session so connections to the eCFR API are kept alive between calls
+SESSION = requests.Session()
+SESSION.headers.update({"accept": "application/json"})
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    # Once retries run out the last response is returned rather than raised,
+    # so callers can skip it on its status code
+    max_retries=Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        raise_on_status=False
+    )
+))
+
 # Create data directory if it doesn't exist
 data_dir = Path("data")
 data_dir.mkdir(exist_ok=True)
 
+# Cached API responses
+xml_cache_dir = data_dir / "xml"
+xml_cache_dir.mkdir(exist_ok=True)
+versions_cache_dir = data_dir / "versions"
+versions_cache_dir.mkdir(exist_ok=True)
+
 # Initialize ChromaDB
 chroma_client = chromadb.PersistentClient(
     path="./data/chroma_db",
     settings=chromadb.Settings(
         anonymized_telemetry=False,
-        allow_reset=True,
+        allow_reset=False,
         is_persistent=True
     )
 )
 
 
-# Create OpenAI embedding function
-openai_ef = embedding_functions.OpenAIEmbeddingFunction(
-    api_key=os.getenv('OPENAI_API_KEY'),
-    model_name="text-embedding-ada-002",  # Using ada-002 for consistent 1536 dimensions
-)
+# Create OpenAI embedding function. Chroma's built-in OpenAI function cannot
+# request shortened embeddings, so embed through batch_embed instead
+class OpenAIEmbeddingFunction(chromadb.EmbeddingFunction):
+    def __call__(self, input):
+        return batch_embed(input)
+
+openai_ef = OpenAIEmbeddingFunction()
 
 def initialize_database():
     """Initialize the database tables if they don't exist"""
@@ -92,6 +215,21 @@ def initialize_database():
         )
     """)
     
+    # No PRIMARY KEY(title, chapter): DuckDB 0.9 raises a duplicate key error when
+    # rows are deleted and inserted again in one transaction, as every load does
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS chapter_hashes (
+            title INTEGER,
+            chapter VARCHAR,
+            hash BLOB
+        )
+    """)
+    
+    # Index the keys the analysis pages join and filter on
+    con.execute("CREATE INDEX IF NOT EXISTS idx_wc_title ON word_counts(title, chapter)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_cv_title_date ON content_versions(title, date)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_acr_agency ON agency_cfr_references(agency_name)")
+    
     # Commit the changes
     con.commit()
 
@@ -107,168 +245,417 @@ def get_or_create_collection():
         collection = chroma_client.create_collection(
             name="ecfr_content",
             embedding_function=openai_ef,
+            metadata=COLLECTION_METADATA,
         )
     return collection
 
 def fetch_titles():
     """Fetch all titles from the versioner API"""
-    response = requests.get(
-        f"{VERSIONER_API}/titles.json",
-        headers={"accept": "application/json"}
-    )
+    response = SESSION.get(f"{VERSIONER_API}/titles.json")
     if response.status_code == 200:
         return response.json()["titles"]
     return None
 
 def fetch_agencies():
     """Fetch all agencies from the admin API"""
-    response = requests.get(
-        f"{ADMIN_API}/agencies.json",
-        headers={"accept": "application/json"}
-    )
+    response = SESSION.get(f"{ADMIN_API}/agencies.json")
     if response.status_code == 200:
         return response.json()["agencies"]
     return None
 
 def fetch_title_structure(title_number, date):
     """Fetch structure for a specific title"""
-    response = requests.get(
-        f"{VERSIONER_API}/structure/{date}/title-{title_number}.json",
-        headers={"accept": "application/json"}
-    )
+    response = SESSION.get(f"{VERSIONER_API}/structure/{date}/title-{title_number}.json")
     if response.status_code == 200:
         return response.json()
     return None
 
+def fetch_cached(url, cache_path, headers=None, revalidate=False):
+    """Fetch a URL through an on-disk cache.
+    Without revalidate, a cached response is returned without touching the network.
+    With revalidate, the cached ETag is sent as If-None-Match and the cached body
+    is reused when the server answers 304 Not Modified."""
+    etag_path = cache_path.with_name(cache_path.name + ".etag")
+    if cache_path.exists() and not revalidate:
+        return cache_path.read_text(encoding="utf-8")
+    
+    headers = dict(headers or {})
+    if cache_path.exists() and etag_path.exists():
+        headers["If-None-Match"] = etag_path.read_text()
+    
+    response = SESSION.get(url, headers=headers)
+    if response.status_code == 304:
+        return cache_path.read_text(encoding="utf-8")
+    if response.status_code != 200:
+        return None
+    
+    # Write atomically so an interrupted load never leaves a partial file
+    tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+    tmp_path.write_bytes(response.content)
+    tmp_path.replace(cache_path)
+    if response.headers.get("ETag"):
+        etag_path.write_text(response.headers["ETag"])
+    elif etag_path.exists():
+        etag_path.unlink()
+    return response.text
+
 def fetch_title_versions(title_number):
-    """Fetch version data for a specific title"""
-    response = requests.get(
+    """Fetch version data for a specific title, revalidating any cached copy"""
+    text = fetch_cached(
         f"{VERSIONER_API}/versions/title-{title_number}.json",
-        headers={"accept": "application/json"}
+        versions_cache_dir / f"title-{title_number}.json",
+        revalidate=True
     )
-    if response.status_code == 200:
-        return response.json()
+    if text:
+        return json.loads(text)
     return None
 
-def fetch_xml_content(title_number, date):
-    """Fetch XML content for a title and optionally a specific part"""
-    url = f"{VERSIONER_API}/full/{date}/title-{title_number}.xml"
-    response = requests.get(url, headers={"accept": "application/xml"})
-    if response.status_code == 200:
-        return response.text
-    return None
+class CachingStream:
+    """Readable byte stream over a streamed HTTP response that copies everything
+    read into a cache file. The cache file is only kept if the whole body was read
+    and the reader called keep(), e.g. once the body has been parsed successfully."""
+    
+    def __init__(self, response, cache_path):
+        self.response = response
+        self.cache_path = cache_path
+        self.tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+        self.tmp_file = open(self.tmp_path, "wb")
+        self.complete = False
+        self.keep_file = False
+    
+    def read(self, size=-1):
+        data = self.response.raw.read(size if size >= 0 else None)
+        if data:
+            self.tmp_file.write(data)
+        else:
+            self.complete = True
+        return data
+    
+    def keep(self):
+        """Keep the cache file when the stream is closed"""
+        self.keep_file = True
+    
+    def close(self):
+        self.response.close()
+        self.tmp_file.close()
+        if self.complete and self.keep_file:
+            self.tmp_path.replace(self.cache_path)
+        else:
+            self.tmp_path.unlink(missing_ok=True)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+
+def open_xml_stream(title_number, date):
+    """Open the full XML for a title as a byte stream. The content for a given
+    date never changes, so a cached copy is read from disk; otherwise the response
+    body is streamed to the parser and cached as it is read."""
+    cache_path = xml_cache_dir / f"title-{title_number}-{date}.xml"
+    if cache_path.exists():
+        return open(cache_path, "rb")
+    
+    response = SESSION.get(
+        f"{VERSIONER_API}/full/{date}/title-{title_number}.xml",
+        headers={"accept": "application/xml"},
+        stream=True
+    )
+    if response.status_code != 200:
+        response.close()
+        return None
+    response.raw.decode_content = True
+    return CachingStream(response, cache_path)
+
+def remove_old_xml(title_number, date):
+    """Delete cached XML for other dates of a title once the given date is cached.
+    Only the latest issue date is ever read, so older copies just take up disk space."""
+    cache_path = xml_cache_dir / f"title-{title_number}-{date}.xml"
+    if not cache_path.exists():
+        return
+    for path in xml_cache_dir.glob(f"title-{title_number}-*.xml"):
+        if path != cache_path:
+            path.unlink(missing_ok=True)
 
 def chunk_text(text, max_chunk_size=6000):
     """Split text into chunks of approximately max_chunk_size tokens.
-    Using a conservative estimate of 4 characters per token."""
-    words = text.split()
+    Using a conservative estimate of 4 characters per token. Each chunk is
+    sliced at the last space before the limit, so words are only split when
+    a single word is longer than a whole chunk."""
+    max_chars = max_chunk_size * 4
     chunks = []
-    current_chunk = []
-    current_length = 0
-    
-    for word in words:
-        word_length = len(word)
-        if current_length + word_length > max_chunk_size * 4:  # Approximate token count
-            chunks.append(' '.join(current_chunk))
-            current_chunk = [word]
-            current_length = word_length
-        else:
-            current_chunk.append(word)
-            current_length += word_length + 1  # +1 for space
+    start = 0
+    length = len(text)
     
-    if current_chunk:
-        chunks.append(' '.join(current_chunk))
+    while start < length:
+        end = min(start + max_chars, length)
+        if end < length:
+            split = text.rfind(' ', start, end + 1)
+            if split > start:
+                end = split
+        chunks.append(text[start:end])
+        # Skip the space the chunk was split on
+        start = end + 1 if end < length and text[end] == ' ' else end
     
     return chunks
 
-def count_words_in_xml(xml_content, title_number=None):
-    """Count words in XML content after stripping tags, broken down by chapter"""
+@njit(cache=True, nogil=True)
+def count_words_in_codepoints(data):
+    """Count whitespace-separated words in an array of Unicode code points.
+    Whitespace is the same set of characters str.split() splits on."""
+    count = 0
+    in_word = False
+    for c in data:
+        # Tab through carriage return, file/group/record/unit separators and space,
+        # next line, no-break space, and the other Unicode space characters
+        if ((c >= 9 and c <= 13) or (c >= 28 and c <= 32) or c == 133 or c == 160
+                or c == 0x1680 or (c >= 0x2000 and c <= 0x200A) or c == 0x2028
+                or c == 0x2029 or c == 0x202F or c == 0x205F or c == 0x3000):
+            in_word = False
+        elif not in_word:
+            count += 1
+            in_word = True
+    return count
+
+def count_words(text):
+    """Count words in text without building a list of them.
+    Gives the same result as len(text.split())."""
+    return count_words_in_codepoints(np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32))
+
+def count_words_in_xml(xml_stream, title_number=None):
+    """Count words in XML content after stripping tags, broken down by chapter.
+
+    Returns a tuple of (chapter_word_counts, documents, chapter_hashes), where
+    documents is a list of (doc_id, chunk, metadata) tuples to be batched into
+    ChromaDB and chapter_hashes maps each stored chapter to a hash of its text."""
     from lxml import etree
-    if not xml_content:
-        return {}
+    if xml_stream is None:
+        return {}, [], {}
     
-    # Parse XML and get text content
+    # Stream through the XML one chapter at a time
     try:
-        root = etree.fromstring(xml_content.encode('utf-8'))
-        
-        # Find all chapter elements
-        chapters = root.xpath('//DIV3[@TYPE="CHAPTER"]')
+        context = etree.iterparse(xml_stream, events=('start', 'end'))
         chapter_word_counts = {}
+        documents = []
+        chapter_hashes = {}
+        chapters_total = 0
+        non_chapter_words = 0
+        in_chapter = False
         
-        for chapter in chapters:
+        for event, elem in context:
+            is_chapter = elem.tag == 'DIV3' and elem.get('TYPE') == 'CHAPTER'
+            if event == 'start':
+                in_chapter = in_chapter or is_chapter
+                continue
+            
+            if not is_chapter:
+                if not in_chapter:
+                    # Count text outside chapters: this element's own text and the tails
+                    # of its children, which have all been handled by now
+                    if elem.text:
+                        non_chapter_words += count_words(elem.text)
+                    for child in elem:
+                        if child.tail:
+                            non_chapter_words += count_words(child.tail)
+                    del elem[:]
+                continue
+            
+            in_chapter = False
+            chapter = elem
+            
             # Get chapter number
             chapter_num = chapter.get('N')
             
-            # Get all text content within this chapter, normalized
-            text = ' '.join(chapter.xpath('.//text()')).strip()
-            word_count = len(text.split())
+            # Get all text content within this chapter. Chapters stored in ChromaDB
+            # are tokenized once, giving both the count and the normalized text
+            text = ' '.join(chapter.itertext())
+            store_text = title_number and int(title_number) <= 10
+            if store_text:
+                words = text.split()
+                word_count = len(words)
+            else:
+                word_count = count_words(text)
             
             # Store in dict with chapter number as key
             chapter_word_counts[chapter_num] = word_count
+            chapters_total += word_count
             
-            # Store chapter text in ChromaDB only for first 10 titles
-            if title_number and int(title_number) <= 10:
-                try:
-                    # Get ChromaDB collection
-                    collection = get_or_create_collection()
+            # Queue chapter text for ChromaDB only for first 10 titles
+            if store_text:
+                # Create metadata
+                base_metadata = {
+                    "title": str(title_number),
+                    "chapter": str(chapter_num),
+                    "word_count": word_count,
+                    "type": "chapter_text"
+                }
+                
+                # Clean and normalize the text
+                cleaned_text = ' '.join(words)  # Remove extra whitespace
+                if len(cleaned_text) > 100:  # Only store if there's meaningful content
+                    # Hash the text so unchanged chapters can skip re-embedding
+                    chapter_hashes[str(chapter_num)] = hashlib.blake2b(
+                        cleaned_text.encode('utf-8'), digest_size=16
+                    ).digest()
                     
-                    # Create metadata
-                    base_metadata = {
-                        "title": str(title_number),
-                        "chapter": str(chapter_num),
-                        "word_count": word_count,
-                        "type": "chapter_text"
-                    }
+                    # Split into chunks if necessary
+                    text_chunks = chunk_text(cleaned_text)
                     
-                    # Clean and normalize the text
-                    cleaned_text = ' '.join(text.split())  # Remove extra whitespace
-                    if len(cleaned_text) > 100:  # Only store if there's meaningful content
-                        # Split into chunks if necessary
-                        text_chunks = chunk_text(cleaned_text)
+                    for i, chunk in enumerate(text_chunks):
+                        # Add chunk number to metadata and ID if text was chunked
+                        metadata = base_metadata.copy()
+                        if len(text_chunks) > 1:
+                            metadata['chunk'] = i + 1
+                            metadata['total_chunks'] = len(text_chunks)
                         
-                        for i, chunk in enumerate(text_chunks):
-                            # Add chunk number to metadata and ID if text was chunked
-                            metadata = base_metadata.copy()
-                            if len(text_chunks) > 1:
-                                metadata['chunk'] = i + 1
-                                metadata['total_chunks'] = len(text_chunks)
-                            
-                            doc_id = f"title_{title_number}_chapter_{chapter_num}"
-                            if len(text_chunks) > 1:
-                                doc_id += f"_chunk_{i+1}"
-                            
-                            collection.add(
-                                documents=[chunk],
-                                metadatas=[metadata],
-                                ids=[doc_id]
-                            )
-                        print(f"Stored chapter {chapter_num} in ChromaDB (length: {len(cleaned_text)} chars)")
-                    else:
-                        print(f"Skipping chapter {chapter_num} - too short ({len(cleaned_text)} chars)")
-                except Exception as e:
-                    print(f"Error storing chapter {chapter_num} in ChromaDB: {str(e)}")
+                        doc_id = f"title_{title_number}_chapter_{chapter_num}"
+                        if len(text_chunks) > 1:
+                            doc_id += f"_chunk_{i+1}"
+                        
+                        documents.append((doc_id, chunk, metadata))
+                    print(f"Queued chapter {chapter_num} for ChromaDB (length: {len(cleaned_text)} chars)")
+                else:
+                    print(f"Skipping chapter {chapter_num} - too short ({len(cleaned_text)} chars)")
+            
+            # Free the chapter's subtree; its tail is counted with the parent
+            chapter.clear(keep_tail=True)
         
-        # Also get total word count
-        total_text = ' '.join(root.xpath('//text()')).strip()
-        chapter_word_counts['total'] = len(total_text.split())
+        # Total word count is the chapter sum plus the text outside chapters
+        chapter_word_counts['total'] = chapters_total + non_chapter_words
         
-        return chapter_word_counts
+        return chapter_word_counts, documents, chapter_hashes
     except Exception as e:
         st.error(f"Error parsing XML: {str(e)}")
-        return {}
+        return {}, [], {}
+
+def batch_embed(texts):
+    """Embed texts with as few OpenAI requests as possible.
+    Texts are grouped greedily by estimated token count (4 characters per token)."""
+    embeddings = []
+    batch = []
+    batch_tokens = 0
+    
+    for text in texts:
+        tokens = len(text) // 4
+        if batch and (batch_tokens + tokens > EMBEDDING_MAX_TOKENS or len(batch) >= EMBEDDING_MAX_INPUTS):
+            response = openai.embeddings.create(
+                model=EMBEDDING_MODEL, input=batch, dimensions=EMBEDDING_DIMENSIONS
+            )
+            embeddings.extend(d.embedding for d in response.data)
+            batch = []
+            batch_tokens = 0
+        batch.append(text)
+        batch_tokens += tokens
+    
+    if batch:
+        response = openai.embeddings.create(
+            model=EMBEDDING_MODEL, input=batch, dimensions=EMBEDDING_DIMENSIONS
+        )
+        embeddings.extend(d.embedding for d in response.data)
+    
+    return embeddings
+
+def fetch_and_count_words(title_number, date):
+    """Fetch the full XML for a title and count its words (runs in a worker thread)"""
+    xml_stream = open_xml_stream(title_number, date=date)
+    if xml_stream is None:
+        return None
+    with xml_stream:
+        result = count_words_in_xml(xml_stream, title_number=title_number)
+        # Only cache a download that parsed, so a bad response is fetched again next time
+        if result[0] and isinstance(xml_stream, CachingStream):
+            xml_stream.keep()
+    remove_old_xml(title_number, date)
+    return result
+
+@contextmanager
+def json_records_file(records, filename):
+    """Write API records to a JSON file in the data directory for DuckDB to ingest.
+    The file is deleted once the block using it is done."""
+    path = data_dir / filename
+    path.write_text(json.dumps(records))
+    try:
+        yield path
+    finally:
+        path.unlink(missing_ok=True)
+
+def add_documents(collection, ids, docs, metadatas):
+    """Embed documents and add them to ChromaDB in a single call"""
+    embeddings = batch_embed(docs)
+    collection.add(
+        documents=docs,
+        metadatas=metadatas,
+        ids=ids,
+        embeddings=embeddings
+    )
+
+def flush_documents(collection, pending_ids, pending_docs, pending_meta):
+    """Add the pending documents to ChromaDB and clear the buffers.
+    Returns the (title, chapter) keys of the chapters that couldn't be stored."""
+    failed = set()
+    if not pending_ids:
+        return failed
+    
+    try:
+        add_documents(collection, pending_ids, pending_docs, pending_meta)
+        print(f"Stored {len(pending_ids)} documents in ChromaDB")
+    except Exception as e:
+        # Retry chapter by chapter so a single bad chunk only loses its own chapter
+        print(f"Error storing {len(pending_ids)} documents in ChromaDB, retrying by chapter: {str(e)}")
+        chapters = {}
+        for doc_id, doc, metadata in zip(pending_ids, pending_docs, pending_meta):
+            key = (int(metadata['title']), metadata['chapter'])
+            chapters.setdefault(key, ([], [], []))
+            chapters[key][0].append(doc_id)
+            chapters[key][1].append(doc)
+            chapters[key][2].append(metadata)
+        for (title_number, chapter), (ids, docs, metadatas) in chapters.items():
+            try:
+                add_documents(collection, ids, docs, metadatas)
+            except Exception as e:
+                print(f"Error storing chapter {chapter} of title {title_number} in ChromaDB: {str(e)}")
+                failed.add((title_number, chapter))
+    
+    pending_ids.clear()
+    pending_docs.clear()
+    pending_meta.clear()
+    return failed
 
 def load_data():
     """Load data from the API into DuckDB"""
     
     try:
-        # Clear ChromaDB collection first
+        # Chapter hashes from the previous load; chapters whose text hasn't
+        # changed keep their existing ChromaDB documents
+        known_hashes = {
+            (title, chapter): chapter_hash
+            for title, chapter, chapter_hash in con.execute(
+                "SELECT title, chapter, hash FROM chapter_hashes"
+            ).fetchall()
+        }
+        current_hashes = {}
+        loaded_titles = set()
+        
+        # A collection created with other index settings has to be rebuilt from scratch,
+        # and an empty one (e.g. after data/chroma_db was removed) has nothing to reuse
         collection = get_or_create_collection()
-        all_docs = collection.get()
-        if all_docs['ids']:
-            st.write(f"Deleting {len(all_docs['ids'])} existing documents from ChromaDB...")
-            collection.delete(ids=all_docs['ids'])
+        if collection.metadata != COLLECTION_METADATA or collection.count() == 0:
+            known_hashes = {}
+        
+        # Without recorded hashes nothing can be reused, so start from an empty
+        # collection. Dropping it is a single operation, unlike deleting every
+        # document from the HNSW index one by one
+        if not known_hashes:
+            st.write("Recreating ChromaDB collection...")
+            chroma_client.delete_collection("ecfr_content")
+            collection = get_or_create_collection()
             st.write("ChromaDB collection cleared")
         
+        # Buffers for batched ChromaDB inserts, and the chapters that couldn't be stored
+        pending_ids, pending_docs, pending_meta = [], [], []
+        failed_chapters = set()
+        
         # Start transaction
         con.execute("BEGIN TRANSACTION")
         print("Starting data load...")
@@ -290,32 +677,40 @@ def load_data():
                 con.execute("ROLLBACK")
                 return
             
-            # Insert agencies and their CFR references
-            for agency in agencies:
-                # Insert agency
-                name = agency['name'].replace("'", "''")
-                short_name = (agency.get('short_name') or '').replace("'", "''")
-                display_name = (agency.get('display_name') or '').replace("'", "''")
-                sortable_name = (agency.get('sortable_name') or '').replace("'", "''")
-                slug = (agency.get('slug') or '').replace("'", "''")
-
-                query = (
-                    f"INSERT INTO agencies VALUES ("
-                    f"'{name}', '{short_name}', '{display_name}', "
-                    f"'{sortable_name}', '{slug}')"
-                )
-                con.execute(query)
-                
-                # Insert CFR references
-                for ref in agency.get('cfr_references', []):
-                    title = int(ref.get('title'))
-                    chapter = (ref.get('chapter') or '').replace("'", "''")
-                    
-                    query = (
-                        f"INSERT INTO agency_cfr_references VALUES ("
-                        f"'{name}', {title}, '{chapter}')"
+            # Load agencies and their CFR references with DuckDB's JSON reader. Column
+            # types are given explicitly, since types guessed from a sample of records
+            # break on later values that don't fit (e.g. a chapter that isn't a number)
+            with json_records_file(agencies, "agencies.json") as agencies_path:
+                con.execute(f"""
+                    INSERT INTO agencies
+                    SELECT
+                        name,
+                        COALESCE(short_name, ''),
+                        COALESCE(display_name, ''),
+                        COALESCE(sortable_name, ''),
+                        COALESCE(slug, '')
+                    FROM read_json_auto('{agencies_path}', columns={{
+                        name: 'VARCHAR',
+                        short_name: 'VARCHAR',
+                        display_name: 'VARCHAR',
+                        sortable_name: 'VARCHAR',
+                        slug: 'VARCHAR'
+                    }})
+                """)
+                con.execute(f"""
+                    INSERT INTO agency_cfr_references
+                    SELECT
+                        name,
+                        ref.title,
+                        COALESCE(ref.chapter, '')
+                    FROM (
+                        SELECT name, UNNEST(cfr_references) as ref
+                        FROM read_json_auto('{agencies_path}', columns={{
+                            name: 'VARCHAR',
+                            cfr_references: 'STRUCT(title INTEGER, chapter VARCHAR)[]'
+                        }})
                     )
-                    con.execute(query)
+                """)
     
         # Then fetch and process titles
         with st.spinner("Fetching and processing titles..."):
@@ -326,79 +721,184 @@ def load_data():
                 con.execute("ROLLBACK")
                 return
             
-            # Process each title
-            for title in titles:
-                title_number = title['number']
-                latest_date = title.get('latest_issue_date')
-                
-                # Insert title
-                con.execute("""
+            # Load all titles with DuckDB's JSON reader
+            with json_records_file(titles, "titles.json") as titles_path:
+                con.execute(f"""
                     INSERT INTO titles (number, name, latest_amended_on, latest_issue_date, up_to_date_as_of, reserved)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                """, [
-                    title_number,
-                    title['name'],
-                    title.get('latest_amended_on'),
-                    latest_date,
-                    title.get('up_to_date_as_of'),
-                    title.get('reserved', False)
-                ])
-                                        
-                # Fetch and count words for entire title at once
-                with st.spinner(f"Counting words for Title {title_number}..."):
-                    full_xml_content = fetch_xml_content(title_number, date=latest_date)
-                    if full_xml_content:
-                        chapter_word_counts = count_words_in_xml(full_xml_content, title_number=title_number)
+                    SELECT
+                        number,
+                        name,
+                        latest_amended_on,
+                        latest_issue_date,
+                        up_to_date_as_of,
+                        COALESCE(reserved, false)
+                    FROM read_json_auto('{titles_path}', columns={{
+                        number: 'INTEGER',
+                        name: 'VARCHAR',
+                        latest_amended_on: 'DATE',
+                        latest_issue_date: 'DATE',
+                        up_to_date_as_of: 'DATE',
+                        reserved: 'BOOLEAN'
+                    }})
+                """)
+            
+            # Fetch and count words for all titles in parallel; DuckDB and
+            # ChromaDB writes stay on this thread
+            with st.spinner("Counting words for all titles..."):
+                wc_rows = []
+                ctx = get_script_run_ctx()
+                with ThreadPoolExecutor(
+                    max_workers=MAX_FETCH_WORKERS,
+                    initializer=add_script_run_ctx,
+                    initargs=(None, ctx)
+                ) as executor:
+                    futures = {
+                        executor.submit(fetch_and_count_words, title['number'], title.get('latest_issue_date')): title
+                        for title in titles
+                    }
+                    for future in as_completed(futures):
+                        title = futures[future]
+                        title_number = title['number']
+                        latest_date = title.get('latest_issue_date')
+                        result = future.result()
+                        if not result:
+                            continue
+                        chapter_word_counts, documents, chapter_hashes = result
+                        if not chapter_word_counts:
+                            # The XML couldn't be parsed; leave this title's documents alone
+                            continue
+                        loaded_titles.add(title_number)
+                        
+                        # Find chapters whose text changed since the last load
+                        changed = set()
+                        for chapter, chapter_hash in chapter_hashes.items():
+                            current_hashes[(title_number, chapter)] = chapter_hash
+                            if known_hashes.get((title_number, chapter)) != chapter_hash:
+                                changed.add(chapter)
                         
-                        # Store word count for each chapter
+                        # Remove stored documents for chapters that changed or no longer exist
+                        stale = [
+                            chapter for (title, chapter) in known_hashes
+                            if title == title_number and (chapter in changed or chapter not in chapter_hashes)
+                        ]
+                        if stale:
+                            collection.delete(where={"$and": [
+                                {"title": str(title_number)},
+                                {"chapter": {"$in": stale}}
+                            ]})
+                        
+                        # Queue chunks of changed chapters and flush to ChromaDB once the batch is full
+                        for doc_id, chunk, metadata in documents:
+                            if metadata['chapter'] not in changed:
+                                continue
+                            pending_ids.append(doc_id)
+                            pending_docs.append(chunk)
+                            pending_meta.append(metadata)
+                            if len(pending_ids) >= CHROMA_BATCH_SIZE:
+                                failed_chapters |= flush_documents(collection, pending_ids, pending_docs, pending_meta)
+                        
+                        # Collect word count for each chapter; the total is stored with a NULL chapter.
+                        # Chapters are stored as the bare number to match agency_cfr_references
                         for chapter_num, word_count in chapter_word_counts.items():
-                            if chapter_num != 'total':
-                                con.execute("""
-                                    INSERT INTO word_counts (title, part, date, word_count, chapter)
-                                    VALUES (?, NULL, ?, ?, ?)
-                                """, [title_number, latest_date, word_count, f"Chapter {chapter_num}"])
-                            else:
-                                # Store total word count with NULL chapter
-                                con.execute("""
-                                    INSERT INTO word_counts (title, part, date, word_count, chapter)
-                                    VALUES (?, NULL, ?, ?, NULL)
-                                """, [title_number, latest_date, word_count])
-        
-                # Fetch and store version data for each title
+                            chapter = str(chapter_num) if chapter_num != 'total' else None
+                            wc_rows.append((title_number, latest_date, word_count, chapter))
+                
+                if wc_rows:
+                    con.executemany("""
+                        INSERT INTO word_counts (title, part, date, word_count, chapter)
+                        VALUES (?, NULL, ?, ?, ?)
+                    """, wc_rows)
+            
+            # Flush any remaining ChromaDB documents
+            failed_chapters |= flush_documents(collection, pending_ids, pending_docs, pending_meta)
+            
+            # Chapters that couldn't be stored in ChromaDB are left out of the recorded
+            # hashes, and any of their chunks that were stored are removed, so they are
+            # embedded again on the next load
+            for title_number in {title for title, _ in failed_chapters}:
+                chapters = [chapter for title, chapter in failed_chapters if title == title_number]
+                for chapter in chapters:
+                    current_hashes.pop((title_number, chapter), None)
+                collection.delete(where={"$and": [
+                    {"title": str(title_number)},
+                    {"chapter": {"$in": chapters}}
+                ]})
+            if failed_chapters:
+                st.warning(f"{len(failed_chapters)} chapters couldn't be stored in ChromaDB and will be retried on the next load")
+            
+            # Keep the hashes of titles that couldn't be loaded this time, since
+            # their documents were left in place
+            for (title, chapter), chapter_hash in known_hashes.items():
+                if title not in loaded_titles:
+                    current_hashes.setdefault((title, chapter), chapter_hash)
+            
+            con.execute("DELETE FROM chapter_hashes")
+            if current_hashes:
+                con.executemany(
+                    "INSERT INTO chapter_hashes VALUES (?, ?, ?)",
+                    [(title, chapter, chapter_hash) for (title, chapter), chapter_hash in current_hashes.items()]
+                )
+            
+            # Fetch version data for each title and load it in one bulk insert
+            versions = []
+            for title in titles:
+                title_number = title['number']
                 with st.spinner("Fetching version data for all titles..."):
                     version_data = fetch_title_versions(title_number)
                     if version_data and 'content_versions' in version_data:
-                        for version in version_data['content_versions']:
-                            # Insert version data with proper SQL escaping
-                            name = version.get('name', '').replace("'", "''")
-                            subpart = (version.get('subpart') or '').replace("'", "''")
-                            con.execute("""
-                                INSERT INTO content_versions 
-                                (title, part, identifier, name, date, amendment_date, issue_date, 
-                                substantive, removed, subpart, type)
-                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                            """, [
-                                title_number,
-                                version.get('part'),
-                                version.get('identifier'),
-                                name,
-                                version.get('date'),
-                                version.get('amendment_date'),
-                                version.get('issue_date'),
-                                version.get('substantive'),
-                                version.get('removed'),
-                                subpart,
-                                version.get('type')
-                            ])
+                        versions.extend(
+                            dict(version, title=title_number)
+                            for version in version_data['content_versions']
+                        )
                     else:
                         print(f"No version data found for title {title_number}")
+            
+            if versions:
+                with json_records_file(versions, "versions.json") as versions_path:
+                    con.execute(f"""
+                        INSERT INTO content_versions
+                        (title, part, identifier, name, date, amendment_date, issue_date,
+                        substantive, removed, subpart, type)
+                        SELECT
+                            title,
+                            part,
+                            identifier,
+                            COALESCE(name, ''),
+                            date,
+                            amendment_date,
+                            issue_date,
+                            substantive,
+                            removed,
+                            COALESCE(subpart, ''),
+                            type
+                        FROM read_json_auto('{versions_path}', columns={{
+                            title: 'INTEGER',
+                            part: 'VARCHAR',
+                            identifier: 'VARCHAR',
+                            name: 'VARCHAR',
+                            date: 'DATE',
+                            amendment_date: 'DATE',
+                            issue_date: 'DATE',
+                            substantive: 'BOOLEAN',
+                            removed: 'BOOLEAN',
+                            subpart: 'VARCHAR',
+                            type: 'VARCHAR'
+                        }})
+                    """)
 
+        # Materialize the cumulative version counts and agency totals so the pages don't recompute them
+        con.execute(f"CREATE OR REPLACE TABLE versions_cum AS {VERSIONS_CUM_QUERY}")
+        con.execute(f"CREATE OR REPLACE TABLE agency_word_totals AS {AGENCY_WORD_TOTALS_QUERY}")
+        
         # Commit the transaction
         con.execute("COMMIT")
         
+        # Cached page results are stale now that the data has been reloaded
+        st.cache_data.clear()
+        
         # Final count check
         st.write("Final table counts:")
-        for table in ['titles', 'word_counts', 'agencies', 'agency_cfr_references', 'content_versions']:
+        for table in ['titles', 'word_counts', 'agencies', 'agency_cfr_references', 'content_versions', 'versions_cum', 'agency_word_totals']:
             count = con.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
             st.write(f"{table}: {count} rows")
         
@@ -412,13 +912,16 @@ def load_data():
 # Initialize DuckDB with a persistent connection
 db_path = data_dir / "ecfr.duckdb"
 
+# The database is opened once per process and each browser session works on its
+# own cursor, kept in the session state so reruns don't open new ones
+@st.cache_resource
 def get_connection():
     """Get a persistent database connection"""
-    conn = duckdb.connect(str(db_path), read_only=False)
-    conn.execute("PRAGMA enable_verification")
-    return conn
+    return duckdb.connect(str(db_path), read_only=False)
 
-con = get_connection()
+if "con" not in st.session_state:
+    st.session_state.con = get_connection().cursor()
+con = st.session_state.con
 
 # Set up the page
 st.set_page_config(
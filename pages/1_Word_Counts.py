@@ -4,21 +4,26 @@ import pandas as pd
 import plotly.express as px
 from pathlib import Path
 
-# Get database connection
+data_dir = Path("data")
+db_path = data_dir / "ecfr.duckdb"
+
+# Get database connection; the database is opened once per process and each
+# browser session works on its own cursor, kept in the session state so reruns
+# don't open new ones
+@st.cache_resource
 def get_connection():
     """Get a persistent database connection"""
-    data_dir = Path("data")
-    db_path = data_dir / "ecfr.duckdb"
-    conn = duckdb.connect(str(db_path), read_only=False)
-    conn.execute("PRAGMA enable_verification")
-    return conn
-
-con = get_connection()
+    return duckdb.connect(str(db_path), read_only=False)
 
-st.title("Word Counts by Chapter")
+if "con" not in st.session_state:
+    st.session_state.con = get_connection().cursor()
+con = st.session_state.con
 
-try:
-    # First show total words by title
+# Query results are cached across reruns; the database mtime is passed as an
+# argument so the cache is invalidated whenever the data is reloaded
+@st.cache_data(ttl=3600)
+def load_totals(db_mtime):
+    """Load total words by title"""
     total_query = """
         SELECT 
             t.number as title_number,
@@ -29,15 +34,11 @@ try:
         WHERE wc.chapter IS NULL
         ORDER BY t.number
     """
-    
-    total_df = pd.read_sql_query(total_query, con)
-    if not total_df.empty:
-        st.write("Total Words by Title:")
-        # Format numbers
-        total_df['total_words'] = total_df['total_words'].apply(lambda x: f"{x:,}" if x else "0")
-        st.dataframe(total_df)
-    
-    # Then show breakdown by chapter
+    return pd.read_sql_query(total_query, con)
+
+@st.cache_data(ttl=3600)
+def load_chapters(db_mtime):
+    """Load word counts by chapter"""
     chapter_query = """
         SELECT 
             t.number as title_number,
@@ -49,8 +50,33 @@ try:
         WHERE wc.chapter IS NOT NULL
         ORDER BY t.number, wc.chapter
     """
+    return pd.read_sql_query(chapter_query, con)
+
+@st.cache_data(ttl=3600)
+def load_agencies(db_mtime):
+    """Load word counts summed by agency, materialized by load_data"""
+    exists = con.execute(
+        "SELECT COUNT(*) FROM information_schema.tables WHERE table_name = 'agency_word_totals'"
+    ).fetchone()[0]
+    if not exists:
+        return pd.DataFrame(columns=['agency', 'total_words'])
+    return pd.read_sql_query("SELECT * FROM agency_word_totals ORDER BY total_words DESC", con)
+
+db_mtime = db_path.stat().st_mtime
+
+st.title("Word Counts by Chapter")
+
+try:
+    # First show total words by title
+    total_df = load_totals(db_mtime)
+    if not total_df.empty:
+        st.write("Total Words by Title:")
+        # Format numbers
+        total_df['total_words'] = total_df['total_words'].apply(lambda x: f"{x:,}" if x else "0")
+        st.dataframe(total_df)
     
-    chapter_df = pd.read_sql_query(chapter_query, con)
+    # Then show breakdown by chapter
+    chapter_df = load_chapters(db_mtime)
     if not chapter_df.empty:
         # Create a stacked bar chart showing chapter distribution for each title
         fig = px.bar(chapter_df, 
@@ -80,7 +106,7 @@ try:
         # Create custom hover text
         hover_text = []
         for _, row in chapter_df.iterrows():
-            chapter_num = row['chapter'].replace('Chapter ', '') if row['chapter'] else 'Unknown'
+            chapter_num = row['chapter'] if row['chapter'] else 'Unknown'
             hover_text.append(f"Chapter {chapter_num}")
             
         fig.update_traces(
@@ -92,38 +118,7 @@ try:
         
     # Show word counts by agency
     st.write("\n### Word Counts by Agency")
-    agency_query = """
-        WITH agency_chapters AS (
-            -- Get all chapters associated with each agency
-            SELECT DISTINCT
-                a.name as agency_name,
-                a.display_name,
-                acr.title,
-                acr.chapter
-            FROM agencies a
-            JOIN agency_cfr_references acr ON a.name = acr.agency_name
-        ),
-        agency_word_counts AS (
-            -- Sum word counts for each agency's chapters
-            SELECT 
-                ac.agency_name,
-                ac.display_name,
-                SUM(wc.word_count) as total_words
-            FROM agency_chapters ac
-            JOIN word_counts wc ON 
-                ac.title = wc.title AND
-                ac.chapter = REPLACE(wc.chapter, 'Chapter ', '')
-            WHERE wc.chapter IS NOT NULL
-            GROUP BY ac.agency_name, ac.display_name
-        )
-        SELECT 
-            COALESCE(display_name, agency_name) as agency,
-            total_words
-        FROM agency_word_counts
-        ORDER BY total_words DESC
-    """
-    
-    agency_df = pd.read_sql_query(agency_query, con)
+    agency_df = load_agencies(db_mtime)
     if not agency_df.empty:
         # Format numbers
         agency_df['total_words'] = agency_df['total_words'].apply(lambda x: f"{x:,}" if x else "0")
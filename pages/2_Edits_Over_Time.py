@@ -3,106 +3,39 @@ import duckdb
 import plotly.express as px
 from pathlib import Path
 
-# Get database connection
+data_dir = Path("data")
+db_path = data_dir / "ecfr.duckdb"
+
+# Get database connection; the database is opened once per process and each
+# browser session works on its own cursor, kept in the session state so reruns
+# don't open new ones
+@st.cache_resource
 def get_connection():
     """Get a persistent database connection"""
-    data_dir = Path("data")
-    db_path = data_dir / "ecfr.duckdb"
-    conn = duckdb.connect(str(db_path), read_only=False)
-    conn.execute("PRAGMA enable_verification")
-    return conn
+    return duckdb.connect(str(db_path), read_only=False)
+
+if "con" not in st.session_state:
+    st.session_state.con = get_connection().cursor()
+con = st.session_state.con
 
-con = get_connection()
+# The cumulative version counts are materialized by load_data; the database
+# mtime is passed as an argument so the cache is invalidated after a reload
+@st.cache_data(ttl=3600)
+def load_versions(db_mtime):
+    """Load cumulative versions over time for each title"""
+    exists = con.execute(
+        "SELECT COUNT(*) FROM information_schema.tables WHERE table_name = 'versions_cum'"
+    ).fetchone()[0]
+    if not exists:
+        return None
+    return con.execute("SELECT * FROM versions_cum").df()
 
 st.title("Content Versions Over Time")
 
 try:
-    # Query to get cumulative versions over time for each title
-    versions_query = """
-    WITH RECURSIVE date_series AS (
-        -- Generate all dates between min and max dates
-        SELECT MIN(date) - INTERVAL '1 day' as date FROM content_versions
-        UNION ALL
-        SELECT date + INTERVAL '1 day'
-        FROM date_series
-        WHERE date < (SELECT MAX(date) FROM content_versions)
-    ),
-    title_dates AS (
-        -- Cross join titles with all dates
-        SELECT 
-            t.number as title,
-            t.name as title_name,
-            ds.date
-        FROM titles t
-        CROSS JOIN date_series ds
-    ),
-    daily_versions AS (
-        SELECT 
-            t.number as title,
-            t.name as title_name,
-            cv.date,
-            COUNT(*) as daily_versions,
-            cv.substantive
-        FROM titles t
-        JOIN content_versions cv ON t.number = cv.title
-        GROUP BY t.number, t.name, cv.date, cv.substantive
-    ),
-    all_versions AS (
-        SELECT 
-            td.title,
-            td.title_name,
-            td.date,
-            COALESCE(SUM(dv.daily_versions), 0) as daily_total
-        FROM title_dates td
-        LEFT JOIN daily_versions dv ON 
-            td.title = dv.title AND 
-            td.date = dv.date
-        GROUP BY td.title, td.title_name, td.date
-    ),
-    substantive_versions AS (
-        SELECT 
-            td.title,
-            td.title_name,
-            td.date,
-            COALESCE(SUM(CASE WHEN dv.substantive THEN dv.daily_versions ELSE 0 END), 0) as daily_substantive
-        FROM title_dates td
-        LEFT JOIN daily_versions dv ON 
-            td.title = dv.title AND 
-            td.date = dv.date
-        GROUP BY td.title, td.title_name, td.date
-    )
-    SELECT 
-        title,
-        title_name,
-        date,
-        SUM(daily_total) OVER (
-            PARTITION BY title
-            ORDER BY date
-            ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW
-        ) as total_versions,
-        SUM(daily_substantive) OVER (
-            PARTITION BY title
-            ORDER BY date
-            ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW
-        ) as substantive_versions
-    FROM (
-        SELECT 
-            av.title,
-            av.title_name,
-            av.date,
-            av.daily_total,
-            sv.daily_substantive
-        FROM all_versions av
-        JOIN substantive_versions sv ON 
-            av.title = sv.title AND 
-            av.date = sv.date
-    )
-    ORDER BY title, date;
-    """
-    
-    versions_df = con.execute(versions_query).df()
+    versions_df = load_versions(db_path.stat().st_mtime)
     
-    if not versions_df.empty:
+    if versions_df is not None and not versions_df.empty:
         # Create two tabs for the different views
         tab1, tab2 = st.tabs(["All Versions", "Substantive Changes Only"])
         
@@ -181,7 +114,7 @@ try:
             with st.expander("View Raw Data"):
                 st.dataframe(versions_df[['date', 'title', 'substantive_versions']])
     else:
-        st.warning("No version data available")
+        st.warning("No version data available. Load the data from the Home page.")
         
 except Exception as e:
     st.error(f"Error generating content versions visualization: {str(e)}")
@@ -1,105 +1,158 @@
 import streamlit as st
+import numpy as np
 
 # Import from Home.py
 from Home import get_or_create_collection, chroma_client, openai_ef
 
+# Titles compared on this page (chapter text is only stored for these)
+TITLES = [str(title) for title in range(1, 11)]
+
+# Number of documents compared against the collection per matrix product
+SIMILARITY_BLOCK_SIZE = 1024
+
 st.title("Most Redundant Chapters")
-st.info("Only looks at the first 10 titles")
+st.info(
+    "Only looks at the first 10 titles. Chapters are compared using shortened "
+    "256-dimension embeddings, which are much cheaper to compare and may rarely "
+    "rank close pairs slightly differently than full-size embeddings"
+)
+
+# The result only depends on the documents in the collection, so it is cached on
+# their ids and reused across reruns until the data is reloaded
+@st.cache_data(show_spinner=False)
+def compute_top_pairs(ids):
+    """Find the top 5 most similar chapter pairs from different titles"""
+    collection = get_or_create_collection()
+    # Rank on embeddings and metadata only; document text is fetched later for
+    # the pairs that are shown
+    all_docs = collection.get(ids=list(ids), include=['embeddings', 'metadatas'])
+    
+    # Normalize the embeddings so dot products are cosine similarities
+    embeddings = np.asarray(all_docs['embeddings'], dtype=np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    
+    # Titles are numbered once so same-title pairs are found by comparing integers
+    _, title_ids = np.unique([meta['title'] for meta in all_docs['metadatas']], return_inverse=True)
+    
+    # Take the most similar documents for each document. Documents are compared
+    # with every other document one block at a time, so only a block of the
+    # similarity matrix is held in memory
+    n_docs = len(embeddings)
+    n_neighbors = min(10, n_docs - 1)
+    neighbors = np.empty((n_docs, n_neighbors), dtype=np.intp)
+    neighbor_similarities = np.empty((n_docs, n_neighbors), dtype=np.float32)
+    for start in range(0, n_docs, SIMILARITY_BLOCK_SIZE):
+        end = start + SIMILARITY_BLOCK_SIZE
+        similarities = embeddings[start:end] @ embeddings.T
+        
+        # Only consider pairs from different titles (this also excludes self-matches)
+        similarities[title_ids[start:end, None] == title_ids[None, :]] = -np.inf
+        
+        block_neighbors = np.argpartition(-similarities, n_neighbors, axis=1)[:, :n_neighbors]
+        neighbors[start:end] = block_neighbors
+        neighbor_similarities[start:end] = np.take_along_axis(similarities, block_neighbors, axis=1)
+    
+    # Flatten the neighbors into candidate pairs, dropping same-title pairs
+    i_idx = np.repeat(np.arange(n_docs), n_neighbors)
+    j_idx = neighbors.ravel()
+    pair_similarities = neighbor_similarities.ravel()
+    valid = pair_similarities > -np.inf
+    i_idx, j_idx, pair_similarities = i_idx[valid], j_idx[valid], pair_similarities[valid]
+    
+    # Number each chapter and pack each chapter pair into a single uint64 key
+    # that is the same regardless of order
+    _, chapter_ids = np.unique(
+        [f"{meta['title']}_{meta['chapter']}" for meta in all_docs['metadatas']],
+        return_inverse=True
+    )
+    chapter1 = chapter_ids[i_idx].astype(np.uint64)
+    chapter2 = chapter_ids[j_idx].astype(np.uint64)
+    pair_keys = (np.minimum(chapter1, chapter2) << np.uint64(32)) | np.maximum(chapter1, chapter2)
+    
+    # Score each chapter pair by its best-scoring pair of documents
+    unique_keys, pair_ids = np.unique(pair_keys, return_inverse=True)
+    best = np.full(len(unique_keys), -np.inf, dtype=np.float32)
+    np.maximum.at(best, pair_ids, pair_similarities)
+    
+    # Select the 5 most similar chapter pairs (higher similarity means more similar)
+    # without sorting the rest, then order just those
+    n_top = min(5, len(best))
+    if n_top == 0:
+        return []
+    top_keys = np.argpartition(-best, n_top - 1)[:n_top]
+    top_keys = top_keys[np.argsort(-best[top_keys], kind='stable')]
+    
+    # Find the pair of documents behind each of them, and build the display
+    # records for those alone
+    top = [
+        np.flatnonzero((pair_ids == key) & (pair_similarities == best[key]))[0]
+        for key in top_keys
+    ]
+    
+    # Fetch the text of just the documents in those pairs
+    doc_ids = list(dict.fromkeys(all_docs['ids'][i] for k in top for i in (i_idx[k], j_idx[k])))
+    top_docs = collection.get(ids=doc_ids, include=['documents'])
+    documents = dict(zip(top_docs['ids'], top_docs['documents']))
+    
+    # Shorten long documents once here instead of on every rerun of the page
+    previews = {
+        doc_id: text[:2000] + "..." if len(text) > 2000 else text
+        for doc_id, text in documents.items()
+    }
+    
+    return [
+        {
+            'pair_id': int(pair_keys[k]),
+            'similarity': float(pair_similarities[k]),
+            'doc1_meta': all_docs['metadatas'][i_idx[k]],
+            'doc2_meta': all_docs['metadatas'][j_idx[k]],
+            'doc1_preview': previews[all_docs['ids'][i_idx[k]]],
+            'doc2_preview': previews[all_docs['ids'][j_idx[k]]]
+        }
+        for k in top
+    ]
 
 if st.button("Find Similar Chapters (⚠️ takes up to 1 minute)"):
     try:
         collection = get_or_create_collection()
-        # Get all documents
-        all_docs = collection.get()
+        # Get the ids of the documents in the compared titles
+        ids = collection.get(where={"title": {"$in": TITLES}}, include=[])['ids']
         
-        if not all_docs['ids']:
+        if not ids:
             st.warning("No documents found in the database. Please load some content first.")
         else:
-            # Create a list to store similarity pairs and a set to track seen pairs
-            similarity_pairs = []
-            seen_pairs = set()
-            
-            # Compare each document with every other document
-            for i in range(len(all_docs['ids'])):
-                # Query using the current document
-                try:
-                    # Request fewer results to avoid HNSW index limitations
-                    n_results = min(10, len(all_docs['ids']) - 1)  # -1 to exclude self
-                    if n_results <= 0:
-                        continue
-                        
-                    results = collection.query(
-                        query_texts=[all_docs['documents'][i]],
-                        n_results=n_results,
-                        include=['documents', 'metadatas', 'distances']
-                    )
-                except Exception as e:
-                    print(f"Error querying document {i}: {str(e)}")
-                    continue
-                
-                # Process results
-                for j in range(len(results['distances'][0])):
-                    doc1_meta = all_docs['metadatas'][i]
-                    doc2_meta = results['metadatas'][0][j]
-                    
-                    # Only consider pairs from different titles
-                    if doc1_meta['title'] == doc2_meta['title']:
-                        continue
-                    
-                    # Create a unique pair identifier that's the same regardless of order
-                    pair_key = tuple(sorted([
-                        f"{doc1_meta['title']}_{doc1_meta['chapter']}",
-                        f"{doc2_meta['title']}_{doc2_meta['chapter']}"
-                    ]))
-                    
-                    # Skip if we've seen this pair before
-                    if pair_key in seen_pairs:
-                        continue
-                    seen_pairs.add(pair_key)
-                    
-                    # Convert distance to similarity
-                    distance = results['distances'][0][j]
-                    similarity = (2 - distance) / 2  # Maps distance [0,2] to similarity [1,0]
-                    
-                    similarity_pairs.append({
-                        'pair_id': pair_key,
-                        'similarity': similarity,
-                        'doc1_meta': doc1_meta,
-                        'doc2_meta': doc2_meta,
-                        'doc1_content': all_docs['documents'][i],
-                        'doc2_content': results['documents'][0][j]
-                    })
-            
-            # Sort pairs by similarity (higher similarity means more similar)
-            similarity_pairs.sort(key=lambda x: x['similarity'], reverse=True)
-            
-            # Display top 5 most similar pairs
-            st.subheader("Top 5 Most Similar Chapter Pairs")
-            
-            # Create tabs for each pair
-            top_pairs = similarity_pairs[:5]
-            tabs = st.tabs([f"Pair {i+1} (Similarity: {pair['similarity']:.2%})" for i, pair in enumerate(top_pairs)])
-            
-            for i, (tab, pair) in enumerate(zip(tabs, top_pairs)):
-                with tab:
-                    # Container for the pair
-                    with st.container():
-                        # Create two columns for the documents
-                        col1, col2 = st.columns(2)
-                        
-                        with col1:
-                            st.markdown(f"**Title {pair['doc1_meta']['title']}, Chapter {pair['doc1_meta']['chapter']}**")
-                            st.markdown(f"Word count: {pair['doc1_meta']['word_count']}")
-                            st.markdown("### Content:")
-                            st.markdown(pair['doc1_content'][:2000] + "..." if len(pair['doc1_content']) > 2000 else pair['doc1_content'])
-                            
-                        with col2:
-                            st.markdown(f"**Title {pair['doc2_meta']['title']}, Chapter {pair['doc2_meta']['chapter']}**")
-                            st.markdown(f"Word count: {pair['doc2_meta']['word_count']}")
-                            st.markdown("### Content:")
-                            st.markdown(pair['doc2_content'][:2000] + "..." if len(pair['doc2_content']) > 2000 else pair['doc2_content'])
-                        
-
+            # Keep the result across reruns, since picking a pair below reruns the
+            # page without the button pressed
+            st.session_state.top_pairs = compute_top_pairs(tuple(ids))
 
     except Exception as e:
         st.error(f"Error finding similar documents: {str(e)}")
+
+if st.session_state.get('top_pairs'):
+    top_pairs = st.session_state.top_pairs
+    
+    # Display top 5 most similar pairs
+    st.subheader("Top 5 Most Similar Chapter Pairs")
+    
+    # Only the selected pair is rendered
+    choice = st.selectbox(
+        "Pair",
+        range(len(top_pairs)),
+        format_func=lambda i: f"Pair {i+1} (Similarity: {top_pairs[i]['similarity']:.2%})"
+    )
+    pair = top_pairs[choice]
+    
+    # Create two columns for the documents
+    col1, col2 = st.columns(2)
+    
+    with col1:
+        st.markdown(f"**Title {pair['doc1_meta']['title']}, Chapter {pair['doc1_meta']['chapter']}**")
+        st.markdown(f"Word count: {pair['doc1_meta']['word_count']}")
+        st.markdown("### Content:")
+        st.markdown(pair['doc1_preview'])
+        
+    with col2:
+        st.markdown(f"**Title {pair['doc2_meta']['title']}, Chapter {pair['doc2_meta']['chapter']}**")
+        st.markdown(f"Word count: {pair['doc2_meta']['word_count']}")
+        st.markdown("### Content:")
+        st.markdown(pair['doc2_preview'])